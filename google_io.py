@@ -1,19 +1,31 @@
 from __future__ import annotations
 
 import json
-from functools import lru_cache
-from typing import List, Dict, Any, Optional
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
+import pandas as pd
 import streamlit as st
 import gspread
-from gspread.exceptions import WorksheetNotFound
+from gspread.utils import absolute_range_name
+from google.auth.transport.requests import Request
 from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+
+from stats_engine import EVENT_LABELS, Player
+
+
+log = logging.getLogger(__name__)
 
 
 # ---------------------------------------------------------
 # Konfiguration & client
 # ---------------------------------------------------------
-@lru_cache(maxsize=1)
+@st.cache_resource(show_spinner=False)
 def load_config() -> Dict[str, Any]:
     """
     Cloud: bruger st.secrets
@@ -32,8 +44,40 @@ def load_config() -> Dict[str, Any]:
         "Mangler config. Opret config.json lokalt eller sæt [app] i Streamlit Secrets."
     )
 
-@lru_cache(maxsize=1)
-def get_gsheet_client() -> gspread.client.Client:
+
+def _authorize(creds: Credentials) -> gspread.client.Client:
+    client = gspread.authorize(creds)
+    # keep-alive pool, så TLS-forbindelser genbruges mellem kald
+    client.http_client.session.mount(
+        "https://", HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    )
+    return client
+
+
+# Stop-signal for den kørende fornyelses-tråd. Bygges _get_credentials igen
+# (fx efter st.cache_resource.clear()), stoppes den gamle tråd, så der kun
+# kører én ad gangen.
+_token_refresh_stop: Optional[threading.Event] = None
+
+
+def _refresh_token_loop(creds: Credentials, stop: threading.Event) -> None:
+    # forny token ca. 5 min før udløb, så ingen klik venter på OAuth
+    while True:
+        wait = 60.0
+        if creds.expiry is not None:
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            wait = (creds.expiry - now).total_seconds() - 300
+        if stop.wait(max(wait, 30.0)):
+            return
+        try:
+            creds.refresh(Request())
+        except Exception:
+            # prøves igen ved næste runde; sessionen kan også selv forny
+            log.exception("Kunne ikke forny Google-token for service account")
+
+
+@st.cache_resource(show_spinner=False)
+def _get_credentials() -> Credentials:
     cfg = load_config()
 
     # Cloud: brug secrets
@@ -42,47 +86,85 @@ def get_gsheet_client() -> gspread.client.Client:
             st.secrets["gcp_service_account"],
             scopes=["https://www.googleapis.com/auth/spreadsheets"],
         )
-        return gspread.authorize(creds)
+    else:
+        # Lokalt: brug filsti fra config.json
+        creds = Credentials.from_service_account_file(
+            cfg["service_account_file"],
+            scopes=["https://www.googleapis.com/auth/spreadsheets"],
+        )
 
-    # Lokalt: brug filsti fra config.json
-    creds = Credentials.from_service_account_file(
-        cfg["service_account_file"],
-        scopes=["https://www.googleapis.com/auth/spreadsheets"],
-    )
-    return gspread.authorize(creds)
+    # hent token nu (ved opstart) i stedet for ved første API-kald
+    creds.refresh(Request())
+
+    global _token_refresh_stop
+    if _token_refresh_stop is not None:
+        _token_refresh_stop.set()
+    _token_refresh_stop = threading.Event()
+    threading.Thread(
+        target=_refresh_token_loop,
+        args=(creds, _token_refresh_stop),
+        name="token-refresh",
+        daemon=True,
+    ).start()
+    return creds
+
+
+@st.cache_resource(show_spinner=False)
+def get_gsheet_client() -> gspread.client.Client:
+    return _authorize(_get_credentials())
+
+
+# Cachede læsninger (Streamlit kører hele scriptet ved hvert klik).
+# Truppen og statistik-filen caches hver for sig, så skrivninger til
+# statistik-filen ikke smider truppen ud af cachen.
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_roster_values(sheet_id: str, range_name: str) -> List[List[str]]:
+    # truppen ligger i en anden fil – åbnes kun ved cache-miss
+    ss = get_gsheet_client().open_by_key(sheet_id)
+    return ss.values_get(range_name).get("values", [])
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_all_values(range_name: str) -> List[List[str]]:
+    """
+    Statistik-filen via det cachede spreadsheet-handle (intet ekstra
+    metadata-kald); ryddes ved skrivning via _invalidate_reads().
+    """
+    return _get_stats_spreadsheet().values_get(range_name).get("values", [])
+
+
+def _invalidate_reads() -> None:
+    _cached_all_values.clear()
+    _stats_index.clear()
 
 
 # ---------------------------------------------------------
 # Spillere fra "truppen"
 # ---------------------------------------------------------
-def load_players() -> List[Dict[str, Any]]:
+def load_players() -> Tuple[Player, ...]:
     cfg = load_config()
-    client = get_gsheet_client()
-
-    sheet = client.open_by_key(cfg["truppen_sheet_id"]).worksheet("truppen")
-    rows = sheet.get_all_values()
+    # række 5 = header, data starter i række 6 – kun kolonne A:F hentes
+    data_rows = _cached_roster_values(cfg["truppen_sheet_id"], "truppen!A6:F")
 
-    # række 5 = header (index 4), data starter i række 6 (index 5)
-    data_rows = rows[5:]
-
-    players: List[Dict[str, Any]] = []
+    players: List[Player] = []
     for r in data_rows:
-        if len(r) < 5:
+        # values.get trimmer tomme celler i enden af rækken
+        if len(r) < 2:
             continue
         if not r[1]:
             continue
 
         players.append(
-            {
-                "name": r[1],
-                "pos_primary": r[2] if len(r) > 2 else "",
-                "pos_secondary": r[3] if len(r) > 3 else "",
-                "team_primary": r[4] if len(r) > 4 else "",
-                "team_secondary": r[5] if len(r) > 5 else "",
-            }
+            Player(
+                name=r[1],
+                pos_primary=r[2] if len(r) > 2 else "",
+                pos_secondary=r[3] if len(r) > 3 else "",
+                team_primary=r[4] if len(r) > 4 else "",
+                team_secondary=r[5] if len(r) > 5 else "",
+            )
         )
 
-    return players
+    return tuple(players)
 
 
 # ---------------------------------------------------------
@@ -90,42 +172,93 @@ def load_players() -> List[Dict[str, Any]]:
 # Struktur (ny):
 # Timestamp | MatchID | Half | Player | Event | Position | Team | Delta | MetaValue
 # ---------------------------------------------------------
-@lru_cache(maxsize=1)
+STATS_HEADER: List[str] = [
+    "Timestamp",
+    "MatchID",
+    "Half",
+    "Player",
+    "Event",
+    "Position",
+    "Team",
+    "Delta",
+    "MetaValue",
+]
+
+# header -> nøgler i event-dicts
+_STATS_KEYS: Dict[str, str] = {
+    "Timestamp": "timestamp",
+    "MatchID": "match_id",
+    "Half": "half",
+    "Player": "player",
+    "Event": "event",
+    "Position": "pos_primary",
+    "Team": "team_primary",
+    "Delta": "delta",
+    "MetaValue": "meta_value",
+}
+
+
+@st.cache_resource(show_spinner=False)
 def _get_stats_spreadsheet() -> gspread.Spreadsheet:
     cfg = load_config()
     client = get_gsheet_client()
     return client.open_by_key(cfg["stats_sheet_id"])
 
 
-def get_stats_worksheet() -> gspread.Worksheet:
+def _values_batch_get(ranges: List[str]) -> List[List[List[str]]]:
+    """Læs flere områder fra statistik-filen i ét kald (values.batchGet)."""
+    resp = _get_stats_spreadsheet().values_batch_get(
+        ranges=ranges, params={"majorDimension": "ROWS"}
+    )
+    return [vr.get("values", []) for vr in resp.get("valueRanges", [])]
+
+
+@st.cache_resource(show_spinner=False)
+def bootstrap() -> Dict[str, gspread.Worksheet]:
+    """
+    Kører én gang pr. proces ved opstart: henter fanerne (ét metadata-kald)
+    og begge headers (ét values.batchGet-kald), opretter 'Matches' og
+    retter headers hvis nødvendigt.
+    """
     ss = _get_stats_spreadsheet()
-    ws = ss.sheet1
-
-    # Sørg for header
-    header = ws.row_values(1)
-    expected = [
-        "Timestamp",
-        "MatchID",
-        "Half",
-        "Player",
-        "Event",
-        "Position",
-        "Team",
-        "Delta",
-        "MetaValue",
-    ]
+    worksheets = ss.worksheets()
+    stats_ws = worksheets[0]
+    matches_ws = next((ws for ws in worksheets if ws.title == "Matches"), None)
+    if matches_ws is None:
+        matches_ws = ss.add_worksheet(title="Matches", rows=200, cols=10)
 
-    # Hvis arket er tomt eller har "gammel" header, så skriver vi ny header i A1:I1.
+    stats_rows, matches_rows = _values_batch_get(
+        [
+            absolute_range_name(stats_ws.title, "A1:I1"),
+            absolute_range_name(matches_ws.title, "A1:D1"),
+        ]
+    )
+    header = stats_rows[0] if stats_rows else []
+    expected = STATS_HEADER
+
+    # Hvis arket er tomt, har "gammel" header eller mangler kolonner
+    # (fx uden Half/MetaValue), så skriver vi ny header i A1:I1.
     # (Dette overskriver kun header-rækken, ikke data)
-    if not header or header[:2] != ["Timestamp", "MatchID"] or len(header) < 7:
-        ws.update("A1:I1", [expected])
+    needs_write = (
+        not header
+        or header[:2] != ["Timestamp", "MatchID"]
+        or len(header) < len(expected)
+    )
 
-    # Hvis header er gammel (fx uden Half/MetaValue), så udvid den forsigtigt
-    # uden at være alt for smart: vi sikrer minimum expected længde.
-    if header and header[:2] == ["Timestamp", "MatchID"] and len(header) < len(expected):
-        ws.update("A1:I1", [expected])
+    # Alle header-rettelser i ét values.batchUpdate-kald
+    data: List[Dict[str, Any]] = []
+    if needs_write:
+        data.append({"range": absolute_range_name(stats_ws.title, "A1:I1"), "values": [expected]})
+    if not matches_rows:
+        data.append({"range": absolute_range_name(matches_ws.title, "A1:D1"), "values": [MATCHES_HEADER]})
+    if data:
+        ss.values_batch_update({"valueInputOption": "RAW", "data": data})
 
-    return ws
+    return {"stats": stats_ws, "matches": matches_ws}
+
+
+def get_stats_worksheet() -> gspread.Worksheet:
+    return bootstrap()["stats"]
 
 
 def _event_to_row(event: Dict[str, Any]) -> List[Any]:
@@ -143,50 +276,153 @@ def _event_to_row(event: Dict[str, Any]) -> List[Any]:
     return [ts, match_id, half, player, ev_name, pos, team, delta, meta]
 
 
+def _values_append(
+    ss: gspread.Spreadsheet, ws: gspread.Worksheet, cols: str, rows: List[List[Any]]
+) -> None:
+    """
+    values.append mod et fast tabelområde (fx "A:I") med INSERT_ROWS, så Sheets
+    ikke selv skal lede efter tabellen i hele arket.
+    """
+    ss.values_append(
+        absolute_range_name(ws.title, cols),
+        params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+        body={"values": rows},
+    )
+
+
 def write_stats_row(event: Dict[str, Any]) -> None:
-    ws = get_stats_worksheet()
-    ws.append_row(_event_to_row(event), value_input_option="USER_ENTERED")
+    write_stats_rows([event])
 
 
 def write_stats_rows(events: List[Dict[str, Any]]) -> None:
     """Batch append (hurtigere og færre API calls)."""
     if not events:
         return
-    ws = get_stats_worksheet()
     rows = [_event_to_row(e) for e in events]
-    ws.append_rows(rows, value_input_option="USER_ENTERED")
+    _values_append(_get_stats_spreadsheet(), get_stats_worksheet(), "A:I", rows)
+    _invalidate_reads()
+
+
+class _FlushRequest:
+    """Markør i køen; workeren skriver resultatet af flush her."""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.error: Optional[Exception] = None
+
+
+class WriteBackQueue:
+    """
+    Skriver events til Stats-arket i baggrunden i bidder (write-back), så en
+    kamp ikke går tabt hvis browseren lukkes før "Afslut".
+    Der skrives når batch_size events er samlet, eller max_wait sekunder efter
+    det første ventende event.
+
+    Worksheet-handles hentes i __init__ (i script-tråden), så worker-tråden
+    ikke kalder st.cache_*-funktioner uden ScriptRunContext. Af samme grund
+    ryddes læse-cachen først i flush(); ellers udløber den via TTL.
+    """
+
+    def __init__(self, batch_size: int = 10, max_wait: float = 5.0) -> None:
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._ss = _get_stats_spreadsheet()
+        self._ws = get_stats_worksheet()
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._pending: List[Dict[str, Any]] = []
+        self._error: Optional[Exception] = None
+        self._thread = threading.Thread(
+            target=self._run, name="stats-writeback", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, event: Dict[str, Any]) -> None:
+        self._queue.put(dict(event))
+
+    def flush(self, timeout: float = 60.0) -> None:
+        """
+        Blokerer til alt lagt i køen før kaldet er skrevet. Resultatet læses fra
+        markøren, så events fra andre sessioner lagt i køen bagefter ikke tæller.
+        Hænger skrivningen, opgives der efter timeout sekunder (TimeoutError).
+        """
+        req = _FlushRequest()
+        self._queue.put(req)
+        if not req.done.wait(timeout):
+            raise TimeoutError(f"Stats-arket svarede ikke inden for {timeout:g} s")
+        _invalidate_reads()
+        if req.error is not None:
+            raise RuntimeError("Kunne ikke skrive events til Stats-arket") from req.error
+
+    def _write_pending(self) -> None:
+        try:
+            _values_append(self._ss, self._ws, "A:I", [_event_to_row(e) for e in self._pending])
+        except Exception as exc:
+            # beholdes og prøves igen ved næste batch / flush
+            self._error = exc
+            return
+        self._pending = []
+        self._error = None
+
+    def _run(self) -> None:
+        deadline: Optional[float] = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            flush = isinstance(item, _FlushRequest)
+            if item is not None and not flush:
+                self._pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_wait
+
+            due = (
+                flush
+                or len(self._pending) >= self.batch_size
+                or (deadline is not None and time.monotonic() >= deadline)
+            )
+            if self._pending and due:
+                self._write_pending()
+                deadline = time.monotonic() + self.max_wait if self._pending else None
+
+            if flush:
+                if self._pending:
+                    item.error = self._error
+                item.done.set()
 
 
 # ---------------------------------------------------------
 # Matches-ark (fane 'Matches' i samme fil)
 # Struktur: MatchID | Date | Team | Opponent
 # ---------------------------------------------------------
+MATCHES_HEADER: List[str] = ["MatchID", "Date", "Team", "Opponent"]
+
+
 def get_matches_worksheet() -> gspread.Worksheet:
-    ss = _get_stats_spreadsheet()
-    try:
-        ws = ss.worksheet("Matches")
-    except WorksheetNotFound:
-        ws = ss.add_worksheet(title="Matches", rows=200, cols=10)
-        ws.update("A1:D1", [["MatchID", "Date", "Team", "Opponent"]])
-    return ws
+    return bootstrap()["matches"]
+
+
+def _match_to_row(match: Dict[str, Any]) -> List[Any]:
+    return [
+        match.get("match_id", ""),
+        match.get("date", ""),
+        str(match.get("team_number", "")),
+        match.get("opponent", ""),
+    ]
 
 
 def append_match_record(match: Dict[str, Any]) -> None:
-    ws = get_matches_worksheet()
-    ws.append_row(
-        [
-            match.get("match_id", ""),
-            match.get("date", ""),
-            str(match.get("team_number", "")),
-            match.get("opponent", ""),
-        ],
-        value_input_option="USER_ENTERED",
+    _values_append(
+        _get_stats_spreadsheet(), get_matches_worksheet(), "A:D", [_match_to_row(match)]
     )
+    _invalidate_reads()
 
 
 def get_all_matches() -> List[Dict[str, Any]]:
     ws = get_matches_worksheet()
-    rows = ws.get_all_values()
+    rows = _cached_all_values(absolute_range_name(ws.title, "A:D"))
     if len(rows) <= 1:
         return []
 
@@ -206,50 +442,39 @@ def get_all_matches() -> List[Dict[str, Any]]:
     return matches
 
 
-def get_stats_for_match(match_id: str) -> List[Dict[str, Any]]:
+@st.cache_resource(ttl=300, show_spinner=False)
+def _stats_index() -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Alle events grupperet pr. MatchID – bygges én gang pr. cache-periode.
+    cache_resource (ikke cache_data), så et opslag ikke kopierer hele indekset;
+    dict'en deles og må derfor kun læses.
+    """
     ws = get_stats_worksheet()
-    rows = ws.get_all_values()
-    if len(rows) <= 1:
-        return []
-
-    data_rows = rows[1:]
-    events: List[Dict[str, Any]] = []
 
-    for r in data_rows:
-        if len(r) < 2:
-            continue
-        if r[1] != match_id:
-            continue
+    # Kun kolonne A:I uden header – ikke hele arket
+    data_rows = _cached_all_values(absolute_range_name(ws.title, "A2:I"))
 
-        # ny struktur:
-        # 0 ts, 1 match, 2 half, 3 player, 4 event, 5 pos, 6 team, 7 delta, 8 meta
-        half = r[2] if len(r) > 2 else ""
-        player = r[3] if len(r) > 3 else ""
-        ev_name = r[4] if len(r) > 4 else ""
-        pos = r[5] if len(r) > 5 else ""
-        team = r[6] if len(r) > 6 else ""
+    # Korte rækker (trimmede tomme celler) paddes til alle 9 kolonner
+    df = pd.DataFrame(data_rows).reindex(columns=range(len(STATS_HEADER)))
+    df.columns = STATS_HEADER
+    df = df[df["MatchID"].notna()].fillna("")
 
-        delta = 1
-        if len(r) > 7 and str(r[7]).strip() != "":
-            try:
-                delta = int(float(r[7]))
-            except ValueError:
-                delta = 1
+    df["Delta"] = (
+        pd.to_numeric(df["Delta"].astype(str).str.strip(), errors="coerce")
+        .fillna(1)
+        .astype(int)
+    )
+    # Event-kolonnen gemmer koder (M, A, ...) – meta-events og ældre rækker
+    # med fulde labels passerer uændret
+    df["Event"] = df["Event"].replace(EVENT_LABELS)
+    df = df.rename(columns=_STATS_KEYS)
 
-        meta = r[8] if len(r) > 8 else ""
+    return {
+        match_id: group.to_dict("records")
+        for match_id, group in df.groupby("match_id", sort=False)
+    }
 
-        events.append(
-            {
-                "timestamp": r[0] if len(r) > 0 else "",
-                "match_id": match_id,
-                "half": half,
-                "player": player,
-                "event": ev_name,
-                "pos_primary": pos,
-                "team_primary": team,
-                "delta": delta,
-                "meta_value": meta,
-            }
-        )
 
-    return events
+def get_stats_for_match(match_id: str) -> List[Dict[str, Any]]:
+    # kopi af hver række, så kaldere ikke ændrer det delte indeks
+    return [dict(e) for e in _stats_index().get(match_id, [])]
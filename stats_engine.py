@@ -1,7 +1,8 @@
 from __future__ import annotations
 
+from dataclasses import dataclass
 from datetime import datetime, date
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
 
 
 STAT_TYPES: List[str] = [
@@ -14,30 +15,70 @@ STAT_TYPES: List[str] = [
     "Rødt kort",
     ]
 
+# (label, kode) – koden skrives i Stats-arkets Event-kolonne
+EVENT_TYPES: List[Tuple[str, str]] = [
+    ("Mål", "M"),
+    ("Assist", "A"),
+    ("Frikast", "F"),
+    ("Redning", "R"),
+    ("Gult kort", "G"),
+    ("2 min", "2"),
+    ("Rødt kort", "X"),
+]
+EVENT_CODES: Dict[str, str] = dict(EVENT_TYPES)
+EVENT_LABELS: Dict[str, str] = {code: label for label, code in EVENT_TYPES}
 
-def create_match_id(match_date: date, team_number: str, opponent: str) -> str:
+
+@dataclass(frozen=True, slots=True)
+class Player:
+    name: str
+    pos_primary: str = ""
+    pos_secondary: str = ""
+    team_primary: str = ""
+    team_secondary: str = ""
+
+
+def format_date(d: date) -> str:
+    # f-string i stedet for strftime (locale-fri)
+    return f"{d.year:04d}-{d.month:02d}-{d.day:02d}"
+
+
+def now_timestamp() -> str:
+    # kaldes ved hvert klik (Registrer) – f-string i stedet for strftime
+    dt = datetime.now()
+    return (
+        f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d} "
+        f"{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
+    )
+
+
+def _match_id(date_str: str, team_number: str, opponent: str) -> str:
     opp_clean = opponent.strip().replace(" ", "_")
-    return f"{match_date.strftime('%Y-%m-%d')}_H{team_number}_{opp_clean}"
+    return f"{date_str}_H{team_number}_{opp_clean}"
+
+
+def create_match_id(match_date: date, team_number: str, opponent: str) -> str:
+    return _match_id(format_date(match_date), team_number, opponent)
 
 
 def create_match(match_date: date, team_number: str, opponent: str) -> Dict[str, Any]:
-    match_id = create_match_id(match_date, team_number, opponent)
+    date_str = format_date(match_date)
     return {
-        "match_id": match_id,
-        "date": match_date.strftime("%Y-%m-%d"),
+        "match_id": _match_id(date_str, team_number, opponent),
+        "date": date_str,
         "team_number": team_number,
         "opponent": opponent.strip(),
     }
 
 
 def build_event(
-    player: Dict[str, Any], event_type: str, match_id: str
+    player: Player, event_type: str, match_id: str
 ) -> Dict[str, Any]:
     return {
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "timestamp": now_timestamp(),
         "match_id": match_id,
-        "player": player["name"],
-        "event": event_type,
-        "pos_primary": player["pos_primary"],
-        "team_primary": player["team_primary"],
+        "player": player.name,
+        "event": EVENT_CODES[event_type],
+        "pos_primary": player.pos_primary,
+        "team_primary": player.team_primary,
     }
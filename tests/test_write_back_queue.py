@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+import google_io
+
+
+class FakeAppend:
+    """Erstatter _values_append; gemmer hvert kald og kan fejle de første gange."""
+
+    def __init__(self, fail_times: int = 0, block: threading.Event | None = None):
+        self.calls = []
+        self.written = []
+        self.fail_times = fail_times
+        self.block = block
+
+    def __call__(self, ss, ws, cols, rows):
+        if self.block is not None:
+            self.block.wait()
+        self.calls.append(list(rows))
+        if self.fail_times:
+            self.fail_times -= 1
+            raise ConnectionError("Sheets nede")
+        self.written.extend(rows)
+
+
+@pytest.fixture
+def fake_append(monkeypatch):
+    def install(**kwargs):
+        fake = FakeAppend(**kwargs)
+        monkeypatch.setattr(google_io, "_get_stats_spreadsheet", lambda: object())
+        monkeypatch.setattr(google_io, "get_stats_worksheet", lambda: object())
+        monkeypatch.setattr(google_io, "_invalidate_reads", lambda: None)
+        monkeypatch.setattr(google_io, "_values_append", fake)
+        return fake
+
+    return install
+
+
+def event(n):
+    return {"match_id": "M1", "player": f"P{n}", "event": "M", "delta": 1}
+
+
+def wait_for(cond, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_writes_when_batch_size_is_reached(fake_append):
+    fake = fake_append()
+    q = google_io.WriteBackQueue(batch_size=3, max_wait=60)
+
+    q.put(event(1))
+    q.put(event(2))
+    time.sleep(0.1)
+    assert fake.calls == []
+
+    q.put(event(3))
+    assert wait_for(lambda: len(fake.calls) == 1)
+    assert [r[3] for r in fake.written] == ["P1", "P2", "P3"]
+
+
+def test_writes_after_max_wait(fake_append):
+    fake = fake_append()
+    q = google_io.WriteBackQueue(batch_size=100, max_wait=0.1)
+
+    q.put(event(1))
+    assert wait_for(lambda: len(fake.calls) == 1)
+    assert [r[3] for r in fake.written] == ["P1"]
+
+
+def test_failed_write_is_retried(fake_append):
+    fake = fake_append(fail_times=1)
+    q = google_io.WriteBackQueue(batch_size=2, max_wait=60)
+
+    q.put(event(1))
+    q.put(event(2))
+    assert wait_for(lambda: len(fake.calls) == 1)
+    assert fake.written == []
+
+    # rækkerne blev beholdt og skrives ved flush – præcis én gang
+    q.flush(timeout=2)
+    assert len(fake.calls) == 2
+    assert fake.calls[0] == fake.calls[1]
+    assert [r[3] for r in fake.written] == ["P1", "P2"]
+
+
+def test_flush_reports_write_error(fake_append):
+    fake = fake_append(fail_times=1)
+    q = google_io.WriteBackQueue(batch_size=100, max_wait=60)
+
+    q.put(event(1))
+    with pytest.raises(RuntimeError) as exc_info:
+        q.flush(timeout=2)
+    assert isinstance(exc_info.value.__cause__, ConnectionError)
+
+    # næste flush lykkes og skriver de ventende rækker
+    q.flush(timeout=2)
+    assert [r[3] for r in fake.written] == ["P1"]
+
+
+def test_flush_times_out(fake_append):
+    release = threading.Event()
+    fake_append(block=release)
+    q = google_io.WriteBackQueue(batch_size=100, max_wait=60)
+
+    q.put(event(1))
+    try:
+        with pytest.raises(TimeoutError):
+            q.flush(timeout=0.1)
+    finally:
+        release.set()
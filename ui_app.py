@@ -1,14 +1,20 @@
 from __future__ import annotations
 
 from datetime import date
-from typing import List, Dict, Any
-from collections import defaultdict
+from typing import Dict, Any, Tuple
+from collections import Counter
 
 import pandas as pd
 import streamlit as st
 
-from google_io import load_players, append_match_record, write_stats_rows
-from stats_engine import create_match, build_event
+from google_io import (
+    bootstrap,
+    load_players,
+    append_match_record,
+    write_stats_rows,
+    WriteBackQueue,
+)
+from stats_engine import EVENT_TYPES, Player, create_match, build_event, now_timestamp
 
 
 st.set_page_config(page_title="Håndbold Stats", layout="wide")
@@ -17,30 +23,27 @@ st.set_page_config(page_title="Håndbold Stats", layout="wide")
 # --------------------------------------------------
 # Konfiguration
 # --------------------------------------------------
-EVENT_TYPES = [
-    ("Mål", "M"),
-    ("Assist", "A"),
-    ("Frikast", "F"),
-    ("Redning", "R"),
-    ("Gult kort", "G"),
-    ("2 min", "2"),
-    ("Rødt kort", "X"),
-]
-
-
 @st.cache_data(ttl=600)
-def get_cached_players() -> List[Dict[str, Any]]:
+def get_cached_players() -> Tuple[Player, ...]:
     return load_players()
 
 
+@st.cache_resource
+def get_write_queue() -> WriteBackQueue:
+    # overlever reruns; events skrives løbende i baggrunden
+    return WriteBackQueue()
+
+
 # --------------------------------------------------
 # Session state
 # --------------------------------------------------
 defaults = {
     "wizard_step": 1,
     "current_match": None,
-    "match_players": [],
-    "events": [],
+    "match_players": (),
+    "players_by_name": {},
+    "event_count": 0,
+    "counts": Counter(),
     "selected_event": None,
     "selected_player": None,
     "current_half": 1,
@@ -52,15 +55,27 @@ for k, v in defaults.items():
 # --------------------------------------------------
 # Helpers
 # --------------------------------------------------
-def find_player(players: List[Dict[str, Any]], name: str) -> Dict[str, Any] | None:
+def find_player(name: str) -> Player | None:
     if not name:
         return None
-    return next((p for p in players if p["name"] == name), None)
+    return st.session_state["players_by_name"].get(name)
+
+
+def selected_row(key: str) -> int | None:
+    """Valgt række i en st.dataframe med on_select (eller None)."""
+    state = st.session_state.get(key)
+    rows = state["selection"]["rows"] if state else []
+    return rows[0] if rows else None
+
+
+def table_height(n_rows: int) -> int:
+    # vis alle rækker uden scroll (header + rækker á 35 px)
+    return 35 * (n_rows + 1) + 3
 
 
 def make_meta_event(match_id: str, event: str, value: str) -> Dict[str, Any]:
     return {
-        "timestamp": pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "timestamp": now_timestamp(),
         "match_id": match_id,
         "half": st.session_state["current_half"],
         "player": "",
@@ -84,32 +99,40 @@ def half_dialog(match_id: str):
         opp = st.number_input("Modstander mål", min_value=0, step=1)
 
     if st.button("Gem", type="primary", use_container_width=True):
-        st.session_state["events"].append(
-            make_meta_event(match_id, "HALVLEG_RESULTAT", f"{ours}-{opp}")
-        )
+        ev = make_meta_event(match_id, "HALVLEG_RESULTAT", f"{ours}-{opp}")
+        st.session_state["event_count"] += 1
+        get_write_queue().put(ev)
         st.rerun()
 
 
 @st.dialog("Afslut kamp")
-def end_dialog(match_id: str, players: List[Dict[str, Any]]):
+def end_dialog(match_id: str, players: Tuple[Player, ...]):
     c1, c2 = st.columns(2)
     with c1:
         ours = st.number_input("Vores mål (slut)", min_value=0, step=1)
     with c2:
         opp = st.number_input("Modstander mål (slut)", min_value=0, step=1)
 
-    mvp = st.selectbox("Kampens spiller", [p["name"] for p in players])
+    mvp = st.selectbox("Kampens spiller", [p.name for p in players])
     comment = st.text_area("Kommentar", height=120)
 
     if st.button("Gem og afslut kamp", type="primary", use_container_width=True):
-        st.session_state["events"].extend([
+        meta_events = [
             make_meta_event(match_id, "SLUT_RESULTAT", f"{ours}-{opp}"),
             make_meta_event(match_id, "KAMPENS_SPILLER", mvp),
             make_meta_event(match_id, "KOMMENTAR", comment.strip()),
-        ])
+        ]
+
+        try:
+            # resten af kampens events er allerede skrevet løbende – tøm køen
+            get_write_queue().flush()
 
-        # 🔥 BATCH WRITE – ÉN GANG
-        write_stats_rows(st.session_state["events"])
+            # slut-meta som ét append-kald
+            write_stats_rows(meta_events)
+        except Exception as exc:
+            # dialogen bliver stående, så der kan prøves igen
+            st.error(f"Kampen kunne ikke gemmes – prøv igen. ({exc})")
+            return
 
         # videre til opsummering
         st.session_state["wizard_step"] = 4
@@ -129,12 +152,14 @@ def step_create_match():
         opp = st.text_input("Modstander")
 
     if st.button("Opret kamp", type="primary", use_container_width=True):
+        # kampen gemmes med det samme, så løbende skrevne events har en kamp
         match = create_match(d, team, opp)
         append_match_record(match)
         st.session_state.update({
             "current_match": match,
             "wizard_step": 2,
-            "events": [],
+            "event_count": 0,
+            "counts": Counter(),
             "selected_event": None,
             "selected_player": None,
             "current_half": 1,
@@ -145,7 +170,7 @@ def step_create_match():
 # --------------------------------------------------
 # Step 2 – Vælg spillere
 # --------------------------------------------------
-def step_select_players(players):
+def step_select_players(players: Tuple[Player, ...]):
     st.subheader("Vælg spillere til kampen")
 
     col1, col2 = st.columns(2)
@@ -158,7 +183,7 @@ def step_select_players(players):
         )
 
     with col2:
-        positions = sorted({p["pos_primary"] for p in players if p["pos_primary"]})
+        positions = sorted({p.pos_primary for p in players if p.pos_primary})
         pos_filter = st.selectbox(
             "Primær position",
             ["Alle"] + positions,
@@ -167,15 +192,15 @@ def step_select_players(players):
 
     filtered = players
     if team_filter != "Alle":
-        filtered = [p for p in filtered if str(p["team_primary"]) == team_filter]
+        filtered = [p for p in filtered if p.team_primary == team_filter]
 
     if pos_filter != "Alle":
-        filtered = [p for p in filtered if p["pos_primary"] == pos_filter]
+        filtered = [p for p in filtered if p.pos_primary == pos_filter]
 
     selected = st.multiselect(
         "Spillere i kampen",
-        options=[p["name"] for p in filtered],
-        default=[p["name"] for p in filtered],  # auto-vælg filtreret hold
+        options=[p.name for p in filtered],
+        default=[p.name for p in filtered],  # auto-vælg filtreret hold
     )
 
     if st.button("Start kamp", type="primary", use_container_width=True):
@@ -183,9 +208,14 @@ def step_select_players(players):
             st.warning("Vælg mindst én spiller.")
             return
 
-        st.session_state["match_players"] = [
-            p for p in players if p["name"] in selected
-        ]
+        chosen = set(selected)
+        st.session_state["match_players"] = tuple(
+            p for p in players if p.name in chosen
+        )
+        # opslag navn -> spiller bygges én gang pr. kamp
+        st.session_state["players_by_name"] = {
+            p.name: p for p in st.session_state["match_players"]
+        }
         st.session_state["wizard_step"] = 3
         st.rerun()
 
@@ -193,7 +223,9 @@ def step_select_players(players):
 
 # --------------------------------------------------
 # Step 3 – Registrering
+# Fragment: klik her kører kun step_record igen, ikke hele appen
 # --------------------------------------------------
+@st.fragment
 def step_record():
     match = st.session_state["current_match"]
     players = st.session_state["match_players"]
@@ -214,11 +246,18 @@ def step_record():
     """, unsafe_allow_html=True)
 
 
-    # tællere
-    counts = defaultdict(int)
-    for e in st.session_state["events"]:
-        if e.get("player"):
-            counts[(e["player"], e["event"])] += 1
+    # tællere (opdateres ved Registrer)
+    counts = st.session_state["counts"]
+
+    # valg fra tabellerne nedenfor – nye tabel-keys efter hver registrering,
+    # så markeringen nulstilles
+    grid = st.session_state["event_count"]
+    type_key, player_key = f"type_grid_{grid}", f"player_grid_{grid}"
+
+    row = selected_row(type_key)
+    st.session_state["selected_event"] = EVENT_TYPES[row][0] if row is not None else None
+    row = selected_row(player_key)
+    st.session_state["selected_player"] = players[row].name if row is not None else None
 
     # topbar (1, 2, Halvleg, Registrer, Afslut)
     t = st.columns([1, 1, 1, 1, 1])
@@ -262,20 +301,22 @@ def step_record():
             disabled=not can,
             use_container_width=True,
         ):
-            p = find_player(players, st.session_state["selected_player"])
+            p = find_player(st.session_state["selected_player"])
             if not p:
                 st.warning("Vælg spiller igen.")
                 st.session_state["selected_player"] = None
-                st.rerun()
+                st.rerun(scope="fragment")
 
             ev = build_event(p, st.session_state["selected_event"], match["match_id"])
             ev["half"] = st.session_state["current_half"]
-            st.session_state["events"].append(ev)
+            st.session_state["event_count"] += 1
+            st.session_state["counts"][(ev["player"], ev["event"])] += 1
+            get_write_queue().put(ev)
 
             # reset UI INSTANT
             st.session_state["selected_event"] = None
             st.session_state["selected_player"] = None
-            st.rerun()
+            st.rerun(scope="fragment")
 
     # Afslut popup
     with t[4]:
@@ -290,38 +331,37 @@ def step_record():
 
     left, right = st.columns([1, 2])
 
-    # Event types (vælg type)
+    # Event types (vælg type) – én tabel i stedet for en knap pr. type
     with left:
-        for label, code in EVENT_TYPES:
-            is_sel = st.session_state.get("selected_event") == label
-            st.button(
-                f"{'✅ ' if is_sel else ''}{label}",
-                key=f"type_{code}",
-                use_container_width=True,
-                on_click=lambda l=label: st.session_state.update({"selected_event": l}),
-            )
+        st.dataframe(
+            pd.DataFrame({"Hændelse": [label for label, _ in EVENT_TYPES]}),
+            key=type_key,
+            on_select="rerun",
+            selection_mode="single-row",
+            hide_index=True,
+            use_container_width=True,
+            height=table_height(len(EVENT_TYPES)),
+        )
 
-    # Players (vælg spiller)
+    # Players (vælg spiller) – én tabel i stedet for knap + badge pr. spiller
     with right:
-        for p in players:
-            name = p["name"]
-            badge = " ".join(
-                f"{code}:{counts[(name, label)]}"
-                for label, code in EVENT_TYPES
-                if counts[(name, label)] > 0
+        badges = [
+            " ".join(
+                f"{code}:{counts[(p.name, code)]}"
+                for _, code in EVENT_TYPES
+                if counts[(p.name, code)] > 0
             )
-
-            c1, c2 = st.columns([3, 1])
-            with c1:
-                is_sel = st.session_state.get("selected_player") == name
-                st.button(
-                    f"{'✅ ' if is_sel else ''}{name}",
-                    key=f"player_{name}",
-                    use_container_width=True,
-                    on_click=lambda n=name: st.session_state.update({"selected_player": n}),
-                )
-            with c2:
-                st.write(badge)
+            for p in players
+        ]
+        st.dataframe(
+            pd.DataFrame({"Spiller": [p.name for p in players], "Stats": badges}),
+            key=player_key,
+            on_select="rerun",
+            selection_mode="single-row",
+            hide_index=True,
+            use_container_width=True,
+            height=table_height(len(players)),
+        )
 
 # --------------------------------------------------
 # Step 4 – Opsummering
@@ -340,6 +380,8 @@ def step_summary():
 # Main
 # --------------------------------------------------
 def main():
+    # faner + headers i ét hug, før første trin vises
+    bootstrap()
     players = get_cached_players()
     step = st.session_state["wizard_step"]
 